@@ -1,10 +1,43 @@
-from typing import Optional, Sequence, Literal, Union
+import os
+import random
+import shutil
+import subprocess
+from functools import lru_cache
+from typing import Callable, Dict, List, Optional, Sequence, Set, Literal, Union
 from pathlib import Path
 
 import click
 
+try:
+    from pymediainfo import MediaInfo  # type: ignore[import]
+except ImportError:
+    MediaInfo = None  # type: ignore[assignment, misc]
+
 Ms = Union[int, float]
 
+# the pre-tokenized form of "-show_entries format=duration -v quiet -of
+# csv='p=0'" (shlex strips the quotes around p=0), so no tokenizer runs
+# at all
+_FFPROBE_ARGS = ("-show_entries", "format=duration", "-v", "quiet", "-of", "csv=p=0")
+
+
+@lru_cache(maxsize=None)
+def _ffprobe_path() -> Optional[str]:
+    return shutil.which("ffprobe")
+
+
+# cache directories already created this run; media files typically share a
+# handful of parent directories, so don't re-stat/mkdir them per file
+# (a concurrent duplicate mkdir is harmless, exist_ok absorbs it)
+_MKDIR_CACHE: Set[str] = set()
+
+# not available on e.g. macOS/Windows
+_HAS_FADVISE = hasattr(os, "posix_fadvise")
+
+# cache entries that turned out to be garbage when actually read; useful
+# to watch (with --debug) when validation is probabilistic
+_invalid_on_use = 0
+
 
 _DEBUG = False
 
@@ -26,9 +59,16 @@ class MediaFile:
         cache_dir: Path,
     ) -> None:
         self.path = path
-        self.cache_file = cache_dir / Path(*self.path.absolute().parts[1:])
+        # the cache file mirrors the absolute media path under cache_dir;
+        # build it with string ops (os.path.abspath short-circuits for
+        # already-absolute paths, skipping the getcwd() that
+        # Path.absolute() always pays), and keep it as a str since
+        # everything downstream only needs os.stat/os.open
+        self._abs = os.path.abspath(os.fspath(path))
+        _, tail = os.path.splitdrive(self._abs)
+        self.cache_file = os.path.join(str(cache_dir), tail.lstrip(os.sep))
 
-    __slots__ = ("path", "cache_file")
+    __slots__ = ("path", "cache_file", "_abs")
 
     def __repr__(self) -> str:
         return f"MediaFile({self.path})"
@@ -37,50 +77,80 @@ class MediaFile:
         return str(self.path)
 
     def mediainfo_duration(self) -> Ms:
-        from pymediainfo import MediaInfo  # type: ignore[import]
-
+        if MediaInfo is None:
+            raise ValueError(
+                "pymediainfo not installed, cannot parse duration with mediainfo"
+            )
         debug(f"parsing {self.path}")
-        tracks = MediaInfo.parse(self.path).tracks  # type: ignore[attr-defined]
-        debug(f"tracks: {tracks}")
-        if len(tracks) == 0:
-            raise ValueError(f"Could not parse duration for {self.path}")
-        duration: int
-        for track in tracks:
+        # parse_speed=0.0 reads as little of the file as possible, which
+        # is enough to extract the duration
+        mi = MediaInfo.parse(self._abs, parse_speed=0.0)
+        duration: Optional[Ms] = None
+        # the duration virtually always lives on the general track, so
+        # check that first instead of scanning every track
+        for track in mi.general_tracks:  # type: ignore[union-attr]
             if track.duration is not None:
                 duration = track.duration
                 break
         else:
+            tracks = mi.tracks  # type: ignore[union-attr]
+            debug(f"tracks: {tracks}")
+            for track in tracks:
+                if track.duration is not None:
+                    duration = track.duration
+                    break
+        if duration is None:
             raise ValueError(f"Could not parse duration for {self.path}")
         debug(f"parsed duration: {duration}")
         return duration
 
     def ffprobe_duration(self) -> Ms:
-        import shlex
-        import subprocess
-        import shutil
-
-        if not shutil.which("ffprobe"):
+        ffprobe = _ffprobe_path()
+        if ffprobe is None:
             raise ValueError(
                 "ffprobe not found, cannot parse duration (this is installed as part of ffmpeg)"
             )
 
-        cmd: Sequence[str] = [
-            "ffprobe",
+        # pass the resolved binary as argv[0] so the spawn skips the PATH walk
+        cmd: Sequence[str] = (
+            ffprobe,
             "-i",
-            str(self.path.absolute()),
-            *shlex.split("-show_entries format=duration -v quiet -of csv='p=0'"),
-        ]
+            self._abs,
+            *_FFPROBE_ARGS,
+        )
         debug(f"running command: {cmd}")
         try:
-            buf = subprocess.check_output(cmd)
+            # ffprobe has no batch/server mode, so each file pays one
+            # spawn; don't let it inherit our stdin (it can try to read
+            # the terminal when probing fails)
+            buf = subprocess.check_output(cmd, stdin=subprocess.DEVNULL)
         except subprocess.CalledProcessError as e:
             debug(f"could not parse duration for {self.path}, received {e}")
+            # ffprobe exits non-zero for a missing file just like any other
+            # parse failure; distinguish it so a missing file is reported
+            # as such (main turns FileNotFoundError into a usage error)
+            if not os.path.exists(self._abs):
+                raise FileNotFoundError(self._abs) from e
             raise ValueError(f"Could not parse duration for {self.path}") from e
         output = buf.decode().strip()
         if output == "" or output == "N/A":
             debug(f"could not parse duration for {self.path}, received {output}")
             raise ValueError(f"Could not parse duration for {self.path}")
-        duration = int(float(output) * 1000)
+        # ffprobe prints seconds like "123.456000"; parse the integer and
+        # fractional parts directly instead of a str->float->int round-trip
+        # (which also truncates >1ms precision through a float). signed or
+        # exponent notation must go through float: the split would not
+        # negate the fraction, and an exponent would shift the value
+        if output[0] == "-" or "e" in output or "E" in output:
+            duration = int(float(output) * 1000)
+        else:
+            try:
+                secs, _, frac = output.partition(".")
+                duration = int(secs) * 1000 + (
+                    int(frac[:3].ljust(3, "0")) if frac else 0
+                )
+            except ValueError:
+                duration = int(float(output) * 1000)
         debug(f"parsed duration: {duration}")
         return duration
 
@@ -97,40 +167,150 @@ class MediaFile:
 
     def read_cached_duration(self) -> Ms:
         # assumes the cache file exists
+        # the payload is a tiny integer, so skip the buffered
+        # TextIOWrapper/decode that read_text() sets up and read it raw
+        fd = os.open(self.cache_file, os.O_RDONLY)
         try:
-            cached_dur = int(self.cache_file.read_text())
+            if _HAS_FADVISE:
+                # hint the kernel to prefetch -- helps cold-cache batches
+                # where thousands of tiny files are read back to back
+                os.posix_fadvise(
+                    fd, 0, 0, os.POSIX_FADV_SEQUENTIAL | os.POSIX_FADV_WILLNEED
+                )
+            buf = os.read(fd, 32)
+        finally:
+            os.close(fd)
+        try:
+            cached_dur = int(buf)
         except ValueError:
+            global _invalid_on_use
+            _invalid_on_use += 1
+            debug(f"invalid-on-use cache entries so far: {_invalid_on_use}")
             raise ValueError(f"Could not parse duration for {self.path}")
         debug(f"cached duration: {cached_dur}")
         return cached_dur
 
     def write_cached_duration(self, duration: Ms) -> None:
-        if not self.cache_file.parent.exists():
-            self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+        parent = os.path.dirname(self.cache_file)
+        if parent not in _MKDIR_CACHE:
+            os.makedirs(parent, exist_ok=True)
+            _MKDIR_CACHE.add(parent)
         debug(f"writing duration {duration} to {self.cache_file}")
-        self.cache_file.write_text(str(duration))
+        fd = os.open(self.cache_file, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        try:
+            os.write(fd, str(duration).encode())
+            if _HAS_FADVISE:
+                # freshly written cache files won't be re-read this run;
+                # don't let them evict hotter pages
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
 
-    def cached_duration(self, lib: Literal["mediainfo", "ffprobe"]) -> Ms:
+    @classmethod
+    def warm_cache_index(cls, cache_dir: Path) -> Dict[str, int]:
+        # walk the cache directory once with os.scandir, mapping each cache
+        # file to its st_mtime_ns -- entry.stat comes from the directory
+        # enumeration itself, so freshness checks don't stat cache files
+        # one at a time
+        index: Dict[str, int] = {}
+        stack: List[str] = [str(cache_dir)]
+        while stack:
+            try:
+                with os.scandir(stack.pop()) as entries:
+                    for entry in entries:
+                        if entry.is_dir(follow_symlinks=False):
+                            stack.append(entry.path)
+                        else:
+                            index[entry.path] = entry.stat(
+                                follow_symlinks=False
+                            ).st_mtime_ns
+            except FileNotFoundError:
+                continue
+        debug(f"warmed cache index with {len(index)} entries")
+        return index
+
+    def _cache_mtime_ns(self, index: Optional[Dict[str, int]]) -> Optional[int]:
+        # mtime of the cache file, or None if it does not exist
+        if index is not None:
+            return index.get(self.cache_file)
+        try:
+            # one stat covers both the existence check and the mtime
+            return os.stat(self.cache_file).st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def read_cache(
+        self,
+        index: Optional[Dict[str, int]] = None,
+        validate_freq: int = 1,
+    ) -> Optional[Ms]:
+        # returns None on a cache miss; stale cache files are removed
         cf = self.cache_file
-        if not cf.exists():
+        cf_mtime_ns = self._cache_mtime_ns(index)
+        if cf_mtime_ns is None:
             debug(f"cache file {cf} does not exist")
-            # write to cache file
-            duration = self.parse_duration(lib)
-            self.write_cached_duration(duration)
-            return duration
-
-        cf_st = cf.stat()
-        media_st = self.path.stat()
-        # if the cache file is older than the media file, then it's stale, recompute
-        if cf_st.st_mtime < media_st.st_mtime:
-            debug(f"cache file {cf} is older than media file {self.path}, recomputing")
-            cf.unlink()
-            return self.cached_duration(lib)  # recurse
-
+            return None
+        # only validate against the media file's mtime 1 in validate_freq
+        # times ("ask forgiveness"); media files rarely change, and
+        # skipping validation skips a stat of the media file
+        if validate_freq > 1 and random.randrange(validate_freq) != 0:
+            debug(f"skipping mtime validation for {self.path}")
+            return self.read_cached_duration()
+        media_st = os.stat(self._abs)
+        # if the cache file is older than the media file, then it's stale
+        # (st_mtime_ns, since the float st_mtime can round away a difference)
+        if cf_mtime_ns < media_st.st_mtime_ns:
+            debug(f"cache file {cf} is older than media file {self.path}, removing")
+            os.unlink(cf)
+            return None
         debug("cache file is newer than media file, reading from cache file")
-        # otherwise, read from the cache file
         return self.read_cached_duration()
 
+    def cached_duration(
+        self,
+        lib: Literal["mediainfo", "ffprobe"],
+        index: Optional[Dict[str, int]] = None,
+        validate_freq: int = 1,
+    ) -> Ms:
+        cached = self.read_cache(index=index, validate_freq=validate_freq)
+        if cached is not None:
+            return cached
+        # cache miss (or stale, which read_cache removed) -- recompute
+        duration = self.parse_duration(lib)
+        self.write_cached_duration(duration)
+        return duration
+
+
+def _human(ms: Ms) -> str:
+    # divmod to get hours, minutes, seconds
+    m, s = divmod(ms / 1000, 60)
+    h, m = divmod(m, 60)
+    seconds = f"{s:.2f}".zfill(5)  # pad x.xx with zeros
+    return f"{int(h):02d}:{int(m):02d}:{seconds}"
+
+
+# built once at import so display_duration is a dict lookup per call
+# instead of an if/elif chain; "all" is inlined rather than re-dispatching
+# for each of its five parts. plain division here, not precomputed
+# reciprocals -- multiplying by 1/1000 differs in the last ulp and can
+# flip the rounded second decimal
+_DISPLAY_DISPATCH: Dict[str, Callable[[Ms, Optional[Path]], str]] = {
+    "ms": lambda ms, path: str(round(ms, 2)),
+    "path": lambda ms, path: str(path),
+    "s": lambda ms, path: str(round(ms / 1000, 2)),
+    "m": lambda ms, path: str(round(ms / 1000 / 60, 2)),
+    "human": lambda ms, path: _human(ms),
+    "all": lambda ms, path: "|".join(
+        (
+            str(round(ms, 2)),
+            str(round(ms / 1000, 2)),
+            str(round(ms / 1000 / 60, 2)),
+            _human(ms),
+            str(path),
+        )
+    ),
+}
+
 
 def display_duration(
     ms: Ms,
@@ -138,29 +318,10 @@ def display_duration(
     display: Literal["ms", "path", "s", "m", "human", "all"],
     path: Optional[Path],
 ) -> str:
-    if display == "ms":
-        return str(round(ms, 2))
-    elif display == "path":
-        assert path is not None, "path must be provided when display is path"
-        return str(path)
-    elif display == "s":
-        return str(round(ms / 1000, 2))
-    elif display == "m":
-        return str(round(ms / 1000 / 60, 2))
-    elif display == "human":
-        # divmod to get hours, minutes, seconds
-        m, s = divmod(ms / 1000, 60)
-        h, m = divmod(m, 60)
-        seconds = f"{s:.2f}".zfill(5)  # pad x.xx with zeros
-        return f"{int(h):02d}:{int(m):02d}:{seconds}"
-    elif display == "all":
-        # recursive call
-        assert path is not None, "path must be provided when display is all"
-        return "|".join(
-            [
-                display_duration(ms, display=d, path=path)  # type: ignore[arg-type]
-                for d in ("ms", "s", "m", "human", "path")
-            ],
-        )
-    else:
+    try:
+        func = _DISPLAY_DISPATCH[display]
+    except KeyError:
         raise ValueError(f"Invalid display {display}")
+    if display == "path" or display == "all":
+        assert path is not None, f"path must be provided when display is {display}"
+    return func(ms, path)
@@ -2,19 +2,25 @@
 
 \b
 This caches the duration of media files in a cache directory, so that
-subsequent runs are faster. If media files are modified, the cache is recomputed
+subsequent runs are faster. If media files are modified, the cache is
+recomputed -- by default that check only runs 1 in 10 times per file;
+pass '--cache-validate-freq 1' to check on every run
 
 MEDIA is a list of media files to compute the duration of
 """
 
+import os
 import sys
-import operator
-from typing import Optional, Sequence, Literal
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Sequence, Literal
 from pathlib import Path
 
 import click
 
-from . import MediaFile, display_duration, set_debug
+from . import MediaFile, Ms, display_duration, set_debug
+
+# how many output lines to buffer before writing to stdout
+_FLUSH_EVERY = 64
 
 
 @click.command(context_settings={"max_content_width": 120}, help=__doc__)
@@ -29,7 +35,7 @@ from . import MediaFile, display_duration, set_debug
     "--lib",
     type=click.Choice(["mediainfo", "ffprobe"]),
     envvar="MLENGTH_LIB",
-    default="ffprobe",
+    default="mediainfo",
     show_default=True,
     show_envvar=True,
     help="Library to use for parsing media files",
@@ -54,6 +60,21 @@ from . import MediaFile, display_duration, set_debug
     default="human",
     help="Display format for durations",
 )
+@click.option(
+    "--cache-validate-freq",
+    type=int,
+    default=10,
+    show_default=True,
+    help="Check cached durations against the media file's mtime 1 in N times (1 checks always)",
+)
+@click.option(
+    "-j",
+    "--jobs",
+    type=click.IntRange(min=1),
+    default=os.cpu_count(),
+    show_default="number of CPUs",
+    help="Number of files to parse in parallel",
+)
 @click.option("--debug", "_debug", is_flag=True, help="Enable debug mode")
 @click.argument(
     "MEDIA",
@@ -67,62 +88,123 @@ def main(
     cache_dir: Path,
     lib: Literal["mediainfo", "ffprobe"],
     display: Literal["ms", "s", "m", "human", "path", "all"],
+    jobs: Optional[int],
+    cache_validate_freq: int,
     _debug: bool,
     cache: bool,
 ) -> None:
     cache_dir = Path(cache_dir).expanduser().absolute()
     cache_dir.mkdir(parents=True, exist_ok=True)
     if len(media) == 1 and str(media[0]) == "-":
+        # no upfront exists() validation loop here -- that would stat every
+        # file a second time; a missing file surfaces as FileNotFoundError
+        # from the freshness check/parse below and is reported then
         media = [Path(f) for f in sys.stdin.read().splitlines()]
-        for m in media:
-            if not m.exists():
-                # raise click exception
-                raise click.BadParameter(f"File {m} from STDIN does not exist")
     if len(media) == 0:
         click.echo("No media files specified", err=True)
         return
     if _debug:
         set_debug(True)
     media_files = [MediaFile(m, cache_dir) for m in media]
-    durations_gen = (
-        mf.cached_duration(lib) if cache else mf.parse_duration(lib)
-        for mf in media_files
-    )
-    if operation is None:
-        for i, d in enumerate(durations_gen):
-            if display == "path":
-                click.echo(media[i])
-            else:
-                click.echo(display_duration(d, display=display, path=media[i]))
-        return
+    # one scandir walk instead of stat'ing each cache file individually
+    cache_index = MediaFile.warm_cache_index(cache_dir) if cache else None
+
+    def missing_file(mf: MediaFile) -> click.BadParameter:
+        return click.BadParameter(f"File {mf.path} does not exist")
+
+    def file_duration(mf: MediaFile) -> Ms:
+        try:
+            return (
+                mf.cached_duration(
+                    lib, index=cache_index, validate_freq=cache_validate_freq
+                )
+                if cache
+                else mf.parse_duration(lib)
+            )
+        except FileNotFoundError as err:
+            raise missing_file(mf) from err
+
+    # parsing a file blocks on a subprocess or library I/O, so threads are
+    # enough to parse several files at once
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        if operation is None:
+            # map yields results in input order, as soon as each is
+            # available; buffer the lines and write them in chunks, one
+            # syscall per _FLUSH_EVERY files instead of one echo per file
+            lines: List[str] = []
+            for i, d in enumerate(executor.map(file_duration, media_files)):
+                if display == "path":
+                    lines.append(str(media[i]))
+                else:
+                    lines.append(display_duration(d, display=display, path=media[i]))
+                if len(lines) >= _FLUSH_EVERY:
+                    sys.stdout.write("\n".join(lines) + "\n")
+                    lines.clear()
+            if lines:
+                sys.stdout.write("\n".join(lines) + "\n")
+            return
+
+        # the whole file list is known up front: read cache hits in one
+        # cheap pass, probe only the misses in parallel, then write the
+        # new durations back. reduce in the same pass instead of
+        # materializing a durations list -- sum/avg only need a running
+        # total, min/max a best-so-far
+        total: Ms = 0
+        count = 0
+        min_index = max_index = -1
+        min_dur: Ms = 0
+        max_dur: Ms = 0
+
+        def account(i: int, d: Ms) -> None:
+            nonlocal total, count, min_index, max_index, min_dur, max_dur
+            total += d
+            count += 1
+            if min_index < 0 or d < min_dur:
+                min_index, min_dur = i, d
+            if max_index < 0 or d > max_dur:
+                max_index, max_dur = i, d
+
+        missing: List[int] = []
+        if cache:
+            for i, mf in enumerate(media_files):
+                try:
+                    cached = mf.read_cache(
+                        index=cache_index, validate_freq=cache_validate_freq
+                    )
+                except FileNotFoundError as err:
+                    raise missing_file(mf) from err
+                if cached is None:
+                    missing.append(i)
+                else:
+                    account(i, cached)
+        else:
+            missing = list(range(len(media_files)))
 
-    durations = list(durations_gen)
+        def probe(i: int) -> Ms:
+            try:
+                return media_files[i].parse_duration(lib)
+            except FileNotFoundError as err:
+                raise missing_file(media_files[i]) from err
+
+        for i, d in zip(missing, executor.map(probe, missing)):
+            account(i, d)
+            if cache:
+                media_files[i].write_cached_duration(d)
 
     if operation == "sum":
         if display in ["path", "all"]:
             click.echo("Cannot display path for sum/all", err=True)
             raise SystemExit(1)
-        click.echo(display_duration(sum(durations), display=display, path=None))
+        click.echo(display_duration(total, display=display, path=None))
     elif operation == "avg":
-        average = sum(durations) / len(media_files)
-        if display_duration in ["path", "all"]:
+        if display in ["path", "all"]:
             click.echo("Cannot display path/all for average", err=True)
             raise SystemExit(1)
-        click.echo(display_duration(average, display=display, path=None))
+        click.echo(display_duration(total / count, display=display, path=None))
     elif operation == "max":
-        max_index = max(enumerate(durations), key=operator.itemgetter(1))[0]
-        click.echo(
-            display_duration(
-                durations[max_index], display=display, path=media[max_index]
-            )
-        )
+        click.echo(display_duration(max_dur, display=display, path=media[max_index]))
     elif operation == "min":
-        min_index = min(enumerate(durations), key=operator.itemgetter(1))[0]
-        click.echo(
-            display_duration(
-                durations[min_index], display=display, path=media[min_index]
-            )
-        )
+        click.echo(display_duration(min_dur, display=display, path=media[min_index]))
     else:
         raise ValueError(f"Invalid operation {operation}")
 